@@ -2,77 +2,93 @@
 to the stage of editing."""
 
 
+import os
+import atexit
+import multiprocessing as mp
+from functools import lru_cache
 import numpy as np
 import pandas as pd
-import scipy.stats as st
+from scipy.special import ndtr
 import RNA
 from sequence_import import Sequence
 from type_definitions import CofoldMode, DockingMode, gRNAExclusion
 from run_settings import (
     no_of_grnas_first, max_grnas_subsequent, editing_window, docking_mode, max_anchor, min_anchor, guides_to_cofold,
     previous_gRNA_exclusion, cofold_mode, proportion_to_dock, minimum_mfe, guide_end_allowance, all_guides_below,
+    parallel_cofold_threshold,
     mismatch_threshold_anchor as mismatches_allowed
 )
 
 
-def split_convert(sequence: str) -> np.array:
-    """Converts a sequence string to a numeric numpy array for matrix calculation of binding."""
+# value used by 'align_guide' to pad the mRNA beyond its 5' end. Must differ from every base value in
+# 'sequence_import.conversion_table'
+alignment_padding = -1
+# number of guides aligned together in a single call to 'align_guide'
+alignment_block_size = 64
 
-    conversion_dict = {'G': 1, 'C': 2, 'A': 11, 'U': 12,
-                       'g': 1, 'c': 2, 'a': 11, 'u': 12}
-    converted = np.array([conversion_dict[char] for char in sequence])
 
-    return np.array(converted)
+def align_guide(messenger: np.array, guide: np.array) -> np.array:
+    """Aligns the guide to the reference mRNA sequence by projecting both sequences together into a matrix.
+    Returns, for each mRNA docking position, the last guide index reached before the mismatch allowance is exceeded
+    (-1 if the allowance is exceeded at the first base).
 
+    The guide is given as a column of shape (guide length, 1). A stack of equal-length guides of shape
+    (no. of guides, guide length, 1) may be given instead, returning one row of results per guide."""
 
-def align_guide(messenger: np.array, guide: np.array) -> dict:
-    """Aligns the guide to the reference mRNA sequence by projecting both sequences together into a matrix."""
+    # each row i of the shifted view holds the mRNA from base i onwards, so that every column is a single
+    # docking position. Positions beyond the 5' end of the mRNA are padded and scored as 9 mismatches
+    guide_length = guide.shape[-2]
+    padded = np.concatenate((messenger, np.full(max(guide_length - 1, 0), alignment_padding, dtype=messenger.dtype)))
+    shifted = np.lib.stride_tricks.sliding_window_view(padded, messenger.size)
 
     # Option 1 allows for GU pairing
-    # matrix = np.where((np.abs(messenger - guide) % 10) == 1, 0, 1)
+    # matrix = ((np.abs(shifted - guide) % 10) != 1).astype(np.int16)
 
     # Option 2 only allows for GC and AU pairing
-    matrix = np.where(np.abs(messenger - guide) == 1, 0, 1)
+    matrix = (np.abs(shifted - guide) != 1).astype(np.int16)
 
-    for i in range(1, guide.size):
-        matrix[i] = np.hstack((matrix[i, i:], np.full(i, 9)))
+    np.copyto(matrix, 9, where=shifted == alignment_padding)
 
-    summed = np.cumsum(matrix, axis=0)
-    guideIdx, refIdx = np.where(summed <= mismatches_allowed)
+    # the mismatch totals only increase along the guide, so counting the guide bases within the allowance gives
+    # the furthest guide index reached at each docking position. The matrix and its running totals are kept as int16,
+    # a quarter of the memory of the default integer type, with a single copy made for the totals
+    summed = np.cumsum(matrix, axis=-2, dtype=np.int16)
 
-    return dict(zip(refIdx, guideIdx))
+    return np.count_nonzero(summed <= mismatches_allowed, axis=-2) - 1
 
 
-def align_all_guides(messenger_sequence: str, guides_dict: dict, excluded_guides: list) -> dict:
+def align_all_guides(messenger: Sequence, guides_dict: dict, excluded_guides: frozenset) -> dict:
     """Align all guides against the given reference sequence and select the candidates for RNAcofold."""
 
-    mes = split_convert(messenger_sequence)
+    mes = messenger.converted
 
-    alignments_dict = {}
-    for guide in guides_dict.values():
-        if guide.name in excluded_guides:
-            pass
-        else:
-            alignments_dict[guide.name] = align_guide(mes, split_convert(guide.seq[:max_anchor]).reshape(max_anchor, 1))
+    candidate_guides = [guide for guide in guides_dict.values() if guide.name not in excluded_guides]
+    anchors = np.array([guide.converted[:max_anchor] for guide in candidate_guides],
+                       dtype=mes.dtype).reshape(len(candidate_guides), max_anchor, 1)
+
+    # one row of alignment scores per candidate guide, one column per mRNA docking position. The guides are aligned
+    # a block at a time, which removes most of the per-call overhead while keeping the matrices small
+    alignment_scores = np.full((len(candidate_guides), mes.size), -1, dtype=np.int16)
+    for i in range(0, len(candidate_guides), alignment_block_size):
+        alignment_scores[i:i + alignment_block_size] = align_guide(mes, anchors[i:i + alignment_block_size])
 
-    alignments_df = pd.DataFrame(alignments_dict)
-    nth_guide_value = np.sort(alignments_df.to_numpy(), axis=None)[::-1][guides_to_cofold - 1]
+    # partial sort to find the n-th highest score, where n is the number of guides to send to RNAcofold
+    nth_guide_value = np.partition(alignment_scores, -guides_to_cofold, axis=None)[-guides_to_cofold]
 
     selected_indices = {}
-    for name in guides_dict.keys():
-        if name in excluded_guides:
-            pass
-        else:
-            indices = alignments_df.index[alignments_df[name] >= nth_guide_value]
-            if len(indices):
-                selected_indices[name] = indices
+    for i, guide in enumerate(candidate_guides):
+        indices = np.flatnonzero(alignment_scores[i] >= nth_guide_value)
+        if len(indices):
+            selected_indices[guide.name] = indices
 
     return selected_indices
 
 
+@lru_cache(maxsize=4096)
 def gen_cofold_string(messenger_sequence: str, guide_sequence: str, docking_idx: int, gIndex=None) -> str:
     """Produces the string for sending to RNAcofold, with sequence trimming in line with the run settings for
-    how much of the guide to include in co-folding."""
+    how much of the guide to include in co-folding. Results are cached, as edit nodes that have merged or share a
+    sequence and indices produce identical strings."""
 
     half_window = editing_window // 2
 
@@ -91,7 +107,6 @@ def gen_cofold_string(messenger_sequence: str, guide_sequence: str, docking_idx:
 
             midx_lower = max(0, docking_idx + gIndex + 1 - half_window)
             midx_upper = min(docking_idx + gIndex + half_window, len(messenger_sequence) - 1)
-            mrna_trimmed = messenger_sequence[midx_lower:midx_upper]
 
     else:
         # trimmed_index = int(len(guide_sequence) * proportion_to_dock)
@@ -101,128 +116,184 @@ def gen_cofold_string(messenger_sequence: str, guide_sequence: str, docking_idx:
     if (not gIndex) or (cofold_mode is not CofoldMode.WINDOW_CENTRED):
         midx_lower = docking_idx
         midx_upper = min(len(guide_trimmed) + docking_idx, len(messenger_sequence))
-        mrna_trimmed = messenger_sequence[midx_lower:midx_upper]
 
-    mrna_trimmed = mrna_trimmed[::-1]
+    # the mRNA region is trimmed and reversed in a single slice. If the indices leave no mRNA region (e.g. docking at
+    # the last mRNA base with 'CofoldMode.WINDOW_CENTRED') the mRNA part of the string is left empty, which
+    # RNAcofold folds with an MFE of 0.0. The reversed slice would otherwise wrap around the end of the sequence
+    if midx_upper <= midx_lower:
+        mrna_trimmed = ''
+    else:
+        mrna_trimmed = messenger_sequence[midx_upper - 1:midx_lower - 1 if midx_lower else None:-1]
 
     cofold_string = f'{mrna_trimmed}&{guide_trimmed}'
 
-    # # CHECKING IF THERE IS AN ERROR IN PRODUCING THE COFOLD STRING - BASED ON AN INDEX ERROR
-    # if cofold_string[0] == '&':
-    #     print('No mRNA string!\nSleeping...')
-    #     for i in range(60):
-    #         print(60 - i)
-    #         time.sleep(1)
-
     return cofold_string
 
 
-def determine_mfe(messenger_sequence: str, guides_dict: dict,
-                  indices_dict: dict, previous_index: int) -> pd.DataFrame:
-    """Calculate MFE using RNAcofold prediction algorithm."""
+# process pool for RNAcofold. It is started on first use and kept for the rest of the run, so that the cost of
+# starting the worker processes is paid once rather than for every batch
+cofold_processes = max(os.cpu_count() - 1, 1)
+cofold_pool = None
+
+
+def close_cofold_pool() -> None:
+    """Closes the shared RNAcofold process pool, if started, waiting for its workers to exit."""
+
+    global cofold_pool
+    if cofold_pool is not None:
+        cofold_pool.close()
+        cofold_pool.join()
+        cofold_pool = None
+
+
+def get_cofold_pool():
+    """Returns the shared RNAcofold process pool, starting it if it doesn't yet exist. The pool is closed when the
+    program exits."""
+
+    global cofold_pool
+    if cofold_pool is None:
+        # the workers are started from a fork server rather than forked from this process directly, as graph
+        # rendering threads (see graph_gen.render_graph) may already be running and holding locks
+        cofold_pool = mp.get_context('forkserver').Pool(processes=cofold_processes)
+        atexit.register(close_cofold_pool)
+
+    return cofold_pool
+
+
+def cofold_chunksize(number_of_strings: int) -> int:
+    """Number of cofold strings sent to each pool worker per task. Roughly four tasks are given to each worker, to
+    balance the load while keeping the inter-process traffic to a few large messages."""
+
+    return max(1, number_of_strings // (4 * cofold_processes))
+
+
+def cofold_all(cofold_strings: list) -> list:
+    """Sends each distinct cofold string to RNAcofold once and returns the (alignment, MFE) results in the order
+    the strings were given. Batches larger than 'parallel_cofold_threshold' are spread across a process pool."""
+
+    unique_strings = list(dict.fromkeys(cofold_strings))
 
-    MFE_pair_list = []
+    if len(unique_strings) > parallel_cofold_threshold:
+        unique_results = get_cofold_pool().map(RNA.cofold, unique_strings,
+                                               chunksize=cofold_chunksize(len(unique_strings)))
+    else:
+        unique_results = [RNA.cofold(cofold_string) for cofold_string in unique_strings]
+
+    results_dict = dict(zip(unique_strings, unique_results))
+
+    return [results_dict[cofold_string] for cofold_string in cofold_strings]
+
+
+def determine_mfe(messenger_sequence: str, guides_dict: dict,
+                  indices_dict: dict, previous_index: int) -> dict:
+    """Calculate MFE using RNAcofold prediction algorithm. Returns the candidates as a dict of NumPy columns, which
+    is only converted to a DataFrame once the candidates have been sorted."""
+
+    # all docking sites are collected first so that they can be sent to RNAcofold as a single batch
+    guide_names = []
+    docking_indices = []
+    cofold_strings = []
     for name, indices in indices_dict.items():
-        MFE_temp_list = []
         for idx in indices:
-            cofold_string = gen_cofold_string(messenger_sequence, guides_dict[name].seq, idx)
-            alignment, MFE = RNA.cofold(cofold_string)
-            MFE_temp_list.append([name, idx, MFE, previous_index])
-        MFE_pair_list += MFE_temp_list
+            guide_names.append(name)
+            docking_indices.append(idx)
+            cofold_strings.append(gen_cofold_string(messenger_sequence, guides_dict[name].seq, idx))
+
+    cofold_results = cofold_all(cofold_strings)
 
-    return pd.DataFrame(MFE_pair_list, columns=['Guide_name', 'mDock', 'MFE', 'prev_index'])
+    # an object array keeps the (interned) name strings from the guides dict, rather than copying them
+    return {'Guide_name': np.array(guide_names, dtype=object),
+            'mDock': np.array(docking_indices, dtype=np.int64),
+            'MFE': np.array([MFE for alignment, MFE in cofold_results], dtype=np.float64),
+            'prev_index': np.full(len(guide_names), previous_index, dtype=np.int64)}
 
 
-def normalise_mfe(MFE_df: pd.DataFrame, current_mIndex) -> pd.DataFrame:
+def normalise_mfe(mfe_columns: dict, current_mIndex) -> dict:
     """Adjusts MFE to favour binding near to the designated mRNA index."""
 
-    mfes = MFE_df['MFE'].to_numpy()
-    idxs = MFE_df['mDock'].to_numpy()
+    mfes = mfe_columns['MFE']
+    idxs = mfe_columns['mDock']
 
     window = 5
 
-    z_score = abs((current_mIndex - idxs) / (window * 2))
-    normalisation_factor = (1 - st.norm.cdf(z_score)) * 2
+    # ndtr is the standard normal CDF as a plain ufunc, avoiding the dispatch overhead of scipy.stats.norm.cdf.
+    # The z-score array is reused in place for the normalisation factor, so only the two output columns are allocated
+    normalisation_factor = np.abs(current_mIndex - idxs) / (window * 2)
+    ndtr(normalisation_factor, out=normalisation_factor)
+    np.subtract(1, normalisation_factor, out=normalisation_factor)
+    normalisation_factor *= 2
     adjusted_mfes = mfes * normalisation_factor
 
-    MFE_df['Normalisation_factor'] = normalisation_factor
-    MFE_df['Adjusted_MFE'] = adjusted_mfes
+    mfe_columns['Normalisation_factor'] = normalisation_factor
+    mfe_columns['Adjusted_MFE'] = adjusted_mfes
 
-    return MFE_df
+    return mfe_columns
 
 
-def sort_candidates(mfe_df: pd.DataFrame, current_mIndex=0, initial=False) -> pd.DataFrame:
+def sort_candidates(mfe_columns: dict, current_mIndex=0, initial=False) -> dict:
     """Determines the need for generating a normalised MFE based on run settings. Then sorts the candidate guides
-    by the MFE/adjusted MFE accordingly. Returns the sorted DatFrame"""
+    by the MFE/adjusted MFE accordingly. Returns the sorted columns"""
 
     if initial:
-        if (docking_mode is DockingMode.INITIATION) or (docking_mode is DockingMode.INITIATION_AND_CURRENT):
-            adjusted_mfe = normalise_mfe(mfe_df, current_mIndex)
-        else:
-            return mfe_df.sort_values(by=['MFE'])
+        normalise = (docking_mode is DockingMode.INITIATION) or (docking_mode is DockingMode.INITIATION_AND_CURRENT)
     else:
-        if (docking_mode is DockingMode.CURRENT_SITE) or (docking_mode is DockingMode.INITIATION_AND_CURRENT):
-            adjusted_mfe = normalise_mfe(mfe_df, current_mIndex)
-        else:
-            return mfe_df.sort_values(by=['MFE'])
+        normalise = (docking_mode is DockingMode.CURRENT_SITE) or (docking_mode is DockingMode.INITIATION_AND_CURRENT)
 
-    return adjusted_mfe.sort_values(by=['Adjusted_MFE'])
+    if normalise:
+        mfe_columns = normalise_mfe(mfe_columns, current_mIndex)
+        sort_by = 'Adjusted_MFE'
+    else:
+        sort_by = 'MFE'
+
+    # quicksort matches the default of DataFrame.sort_values, so equal MFEs keep the same order as before
+    order = np.argsort(mfe_columns[sort_by], kind='quicksort')
+
+    return {column: values[order] for column, values in mfe_columns.items()}
 
 
-def get_index(messenger_sequence: str, guide_sequence: str, dock_index: int):
+def get_index(messenger: Sequence, guide: Sequence, dock_index: int):
     """Aligns the candidate sequences and determines the base to begin editing - the gIndex."""
 
+    messenger_converted = messenger.converted[dock_index:dock_index + guide.length]
+    guide_converted = guide.converted[:messenger_converted.size]
+
     # Option 1 allows GU pairing in anchor region
-    # match_set = {'gc', 'cg', 'au', 'ua', 'gu', 'ug'}
+    # mismatched = (np.abs(messenger_converted - guide_converted) % 10) != 1
 
     # Option 2 doesn't allow GU pairing in anchor region
-    match_set = {'gc', 'cg', 'au', 'ua'}
-
-    anchor_length = 0
-    mismatches = 0
-    consecutive_mismatches = 0
-    index_chosen = False
+    mismatched = np.abs(messenger_converted - guide_converted) != 1
 
     # the minimum anchor length permissible by the 'run_settings' is passed without stopping (unless the
     # 'mismatches_allowed' limit is exceeded in this area - unlikely). After which, the first mismatch
     # encountered is the point at which editing begins - gIndex. This is regardless of whether the
     # 'mismatches_allowed' limit has been reached.
-    for i, (m, g) in enumerate(zip(messenger_sequence[dock_index:dock_index + len(guide_sequence)], guide_sequence)):
-        if m + g in match_set:
-            consecutive_mismatches = 0
-        else:
-            mismatches += 1
-            consecutive_mismatches += 1
-            if i >= min_anchor:
-                index_chosen = True
-        anchor_length += 1
-
-        if mismatches > mismatches_allowed:
-            index_chosen = True
-
-        if index_chosen:
-            break
+    past_min_anchor = np.arange(messenger_converted.size) >= min_anchor
+    stops = np.flatnonzero((mismatched & past_min_anchor) | (np.cumsum(mismatched) > mismatches_allowed))
+    anchor_length = stops[0] + 1 if stops.size else messenger_converted.size
 
-    gIndex = anchor_length - consecutive_mismatches
+    # editing begins immediately after the last paired base of the anchor, discounting any trailing mismatches
+    paired = np.flatnonzero(~mismatched[:anchor_length])
+    gIndex = int(paired[-1]) + 1 if paired.size else 0
 
-    if gIndex + guide_end_allowance >= len(guide_sequence):
+    if gIndex + guide_end_allowance >= guide.length:
         return 0
 
     return gIndex
 
 
-def get_excluded_guides(previous_guides: list) -> list:
-    """Determines which guides to exclude based on the run settings."""
+def get_excluded_guides(previous_guides: tuple) -> frozenset:
+    """Determines which guides to exclude based on the run settings. Returned as a set, since every guide name is
+    checked against it."""
 
     if previous_guides:
         if previous_gRNA_exclusion is gRNAExclusion.ALL:
-            return previous_guides
+            return frozenset(previous_guides)
         elif previous_gRNA_exclusion is gRNAExclusion.ONE:
-            return [previous_guides[-1]]
+            return frozenset((previous_guides[-1],))
         elif previous_gRNA_exclusion is gRNAExclusion.NONE:
-            return []
+            return frozenset()
     else:
-        return []
+        return frozenset()
 
 
 def select_guides(messenger: Sequence, guides_dict: dict, previous_guides=None, current_mIndex=0, initial=False):
@@ -235,13 +306,13 @@ def select_guides(messenger: Sequence, guides_dict: dict, previous_guides=None,
     excluded_guides = get_excluded_guides(previous_guides)
     messenger_sequence = messenger.seq
     # print(messenger_sequence)
-    indices = align_all_guides(messenger_sequence=messenger_sequence,
+    indices = align_all_guides(messenger=messenger,
                                guides_dict=guides_dict,
                                excluded_guides=excluded_guides)
-    mfe_df = determine_mfe(messenger_sequence, guides_dict, indices, previous_index=current_mIndex)
-    candidates_sorted = sort_candidates(mfe_df, current_mIndex, initial=initial)
+    mfe_columns = determine_mfe(messenger_sequence, guides_dict, indices, previous_index=current_mIndex)
+    candidates_sorted = sort_candidates(mfe_columns, current_mIndex, initial=initial)
 
-    mfe_filtered = candidates_sorted[candidates_sorted['MFE'] < minimum_mfe].reset_index(drop=True)
+    below_minimum = candidates_sorted['MFE'] < minimum_mfe
 
     # print(candidates_sorted.head(10))
 
@@ -252,18 +323,20 @@ def select_guides(messenger: Sequence, guides_dict: dict, previous_guides=None,
     # print('sleeping')
     # time.sleep(5)
     output_duplexes = []
-    for i in range(len(mfe_filtered['Guide_name'])):
-        if (len(output_duplexes) >= no_of_guides) & (mfe_filtered.iloc[i]['MFE'] > all_guides_below):
+    selected_guides = set()
+    guide_names = candidates_sorted['Guide_name'][below_minimum].tolist()
+    docking_indices = candidates_sorted['mDock'][below_minimum].tolist()
+    mfes = candidates_sorted['MFE'][below_minimum].tolist()
+    for i, (name, mDock, mfe) in enumerate(zip(guide_names, docking_indices, mfes)):
+        if (len(output_duplexes) >= no_of_guides) & (mfe > all_guides_below):
             break
-        if any(mfe_filtered['Guide_name'].loc[i] in l for l in output_duplexes):
+        if name in selected_guides:
             print(f'Guide {i} has a preferred alternative binding site.')
-            pass
         else:
-            candidate = mfe_filtered[['Guide_name', 'mDock']].loc[i].to_list()
-            gIndex = get_index(messenger_sequence, guides_dict[candidate[0]].seq, candidate[1])
+            gIndex = get_index(messenger, guides_dict[name], mDock)
             if gIndex >= min_anchor:
-                candidate.append(messenger)
-                candidate.append(gIndex)
-                output_duplexes.append(candidate)
+                output_duplexes.append([name, mDock, messenger, gIndex])
+                selected_guides.add(name)
 
-    return output_duplexes, candidates_sorted.reset_index(drop=True)
+    # the candidates are only converted to a DataFrame here, for saving alongside the other outputs
+    return output_duplexes, pd.DataFrame(candidates_sorted)
@@ -6,7 +6,8 @@ from docking import gen_cofold_string
 from type_definitions import NodeType
 from run_settings import mismatch_threshold_editing, probability_threshold, guide_end_allowance
 import RNA
-from copy import copy
+import numpy as np
+from functools import cached_property
 
 
 class EditNode:
@@ -14,6 +15,14 @@ class EditNode:
 
     mismatch_set = {'gg', 'cc', 'aa', 'uu', 'ga', 'ag', 'ac', 'ca', 'cu', 'uc'}
 
+    # the mismatch set as a table indexed by the ASCII codes of the mRNA and guide bases. The flattened bytes copy
+    # allows single-pair lookups without building a new pair string
+    mismatch_table = np.zeros((128, 128), dtype=np.uint8)
+    for pair in mismatch_set:
+        mismatch_table[ord(pair[0]), ord(pair[1])] = 1
+    del pair
+    mismatch_bytes = mismatch_table.tobytes()
+
     def __init__(self, edit_tree, action: str, parent=None):
         self.edit_tree = edit_tree
         self.guide = self.edit_tree.guide_sequence
@@ -30,7 +39,6 @@ class EditNode:
         self.probability_calculated = False
 
         self.edit_level: int
-        self.action_log: str
         self.init_sequence: Sequence
         self.sequence: Sequence
         self.mIndex: int
@@ -39,12 +47,18 @@ class EditNode:
         self.probability: float
         self.probability_product: float
         self.combined_parent_prob_prod: float
-        self.cofold_string: str
         self.mfe: float
         self.alignment: str
 
         # self.pairs: str
 
+    @property
+    def action_log(self) -> str:
+        """The actions taken from the root node up to and including this node. Each node id is its parent's id
+        followed by its own action, so the log is read from the end of the id rather than stored separately."""
+
+        return self.id[len(self.edit_tree.id) + 1:]
+
     def __lt__(self, other):
         return self.edit_level < other.edit_level
 
@@ -111,20 +125,14 @@ class EditNode:
     def count_all_mismatches(self) -> int:
         """Counts the number of mismatches in the entire sequence paired between the guide RNA and mRNA.
 
-        A slower method that iterates over the entire paired sequence. Only used to confirm the correct
+        A slower method that compares the entire paired sequence. Only used to confirm the correct
         functionality of the cumulative use of count_mismatch method. Not used in the final program."""
 
-        pair_string = ''
-        mismatches = 0
-        for i in range(self.gIndex + 1):
-            m_base = f'{self.sequence.seq[i + self.edit_tree.init_mIndex - self.edit_tree.init_gIndex]}'
-            g_base = f'{self.guide.seq[i]}'
-            current_pair = m_base + g_base
-            if current_pair in EditNode.mismatch_set:
-                mismatches += 1
-            pair_string = pair_string + f'({current_pair})'
+        m_start = self.edit_tree.init_mIndex - self.edit_tree.init_gIndex
+        m_bases = self.sequence.seq_array[m_start:m_start + self.gIndex + 1]
+        g_bases = self.guide.seq_array[:self.gIndex + 1]
 
-        # self.pairs = pair_string
+        mismatches = int(EditNode.mismatch_table[m_bases, g_bases].sum())
 
         return mismatches
 
@@ -139,10 +147,31 @@ class EditNode:
 
         return cofold_string
 
+    @cached_property
+    def cofold_string(self) -> str:
+        """The string sent to RNAcofold. Only built when the node is actually co-folded, since most nodes become
+        leaves or are never selected for co-folding."""
+
+        return self.set_cofold_string()
+
+    def reuse_parent_cofold(self) -> bool:
+        """Takes the RNAcofold result of the parent node if the cofold strings are identical. Returns True if the
+        parent's result was used."""
+
+        # a 'pass' node shares its parent's sequence, so once the trimmed window stops moving (e.g. the whole guide
+        # is co-folded, or the guide end has been reached) the cofold string is identical and the parent's
+        # result is reused
+        if (self.action == 'p') and hasattr(self.parent, 'mfe') and (self.cofold_string == self.parent.cofold_string):
+            self.alignment, self.mfe = self.parent.alignment, self.parent.mfe
+            return True
+
+        return False
+
     def cofold_sequence(self) -> float:
         """Calculates MFE by sending the correctly formatted cofold string to RNAcofold."""
 
-        self.alignment, self.mfe = RNA.cofold(self.cofold_string)
+        if not self.reuse_parent_cofold():
+            self.alignment, self.mfe = RNA.cofold(self.cofold_string)
 
         return self.mfe
 
@@ -179,10 +208,9 @@ class EditNodeRoot(EditNode):
         self.id = f'{self.edit_tree.id}_{self.action}'
         self.parent_id = None
         self.edit_level = 0
-        self.action_log = self.action
 
-        self.mIndex = copy(self.edit_tree.init_mIndex)
-        self.gIndex = copy(self.edit_tree.init_gIndex)
+        self.mIndex = self.edit_tree.init_mIndex
+        self.gIndex = self.edit_tree.init_gIndex
 
         self.init_sequence = init_seq
         self.sequence = self.init_sequence
@@ -194,7 +222,6 @@ class EditNodeRoot(EditNode):
         self.probability_product = 1.0
 
         self.node_type = self.set_node_type()
-        self.cofold_string = self.set_cofold_string()
         # self.mismatches_full = self.count_all_mismatches()
 
 
@@ -208,18 +235,16 @@ class EditNodeChild(EditNode):
         self.id = f'{self.parent.id}{self.action}'
         self.parent_id = self.parent.id
         self.edit_level = self.parent.edit_level + 1
-        self.action_log = self.parent.action_log + self.action
 
         if self.parent.action in {'p', 'i'}:
             self.mIndex = self.parent.mIndex + 1
             self.gIndex = self.parent.gIndex + 1
         else:
-            self.mIndex = copy(self.parent.mIndex)
-            self.gIndex = copy(self.parent.gIndex)
+            self.mIndex = self.parent.mIndex
+            self.gIndex = self.parent.gIndex
         # print(f'Action: {action}; mIndex - Parent: {self.parent.mIndex}, Self: {self.mIndex}')
 
-        self.init_sequence = self.parent.sequence
-        self.sequence = self.edit(init_sequence=self.init_sequence)
+        self.sequence = self.edit(init_sequence=self.parent.sequence)
 
         if self.parent.action == 'd':
             self.prev_gIndex_mismatch_total = self.parent.prev_gIndex_mismatch_total
@@ -228,19 +253,27 @@ class EditNodeChild(EditNode):
         self.mismatches = self.prev_gIndex_mismatch_total + self.check_mismatch()
 
         self.node_type = self.set_node_type()
-        self.cofold_string = self.set_cofold_string()
         # self.mismatches_full = self.count_all_mismatches()
 
+    @property
+    def init_sequence(self) -> Sequence:
+        """The sequence prior to this node's editing decision, which is always the parent's (possibly shared)
+        sequence, so it is looked up rather than stored on every node."""
+
+        return self.parent.sequence
+
     def edit(self, init_sequence: Sequence) -> Sequence:
-        """Performs the editing decision on the inherited RNA sequence."""
+        """Performs the editing decision on the inherited RNA sequence. A 'pass' leaves the sequence unchanged, so the
+        inherited Sequence object is shared rather than copied."""
+
+        if self.action == 'p':
+            return init_sequence
 
         prev_seq = init_sequence.seq3to5
         if self.action == 'i':
-            new_seq = f'{prev_seq[:self.mIndex]}U{prev_seq[self.mIndex:]}'
-        elif self.action == 'd':
-            new_seq = f'{prev_seq[:self.mIndex]}{prev_seq[self.mIndex + 1:]}'
+            new_seq = f'{prev_seq[:self.mIndex]}u{prev_seq[self.mIndex:]}'
         else:
-            new_seq = prev_seq
+            new_seq = f'{prev_seq[:self.mIndex]}{prev_seq[self.mIndex + 1:]}'
 
         return Sequence(name=self.id, sequence=new_seq, seq_is_5to3=False)
 
@@ -250,7 +283,4 @@ class EditNodeChild(EditNode):
         current_base_m = self.sequence.seq3to5[self.mIndex]
         current_base_g = self.edit_tree.guide_sequence.seq[self.gIndex]
 
-        if f'{current_base_m}{current_base_g}' in EditNode.mismatch_set:
-            return 1
-        else:
-            return 0
+        return EditNode.mismatch_bytes[ord(current_base_m) << 7 | ord(current_base_g)]
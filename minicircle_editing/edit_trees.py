@@ -2,23 +2,35 @@
 machinery either deletes or inserts a U, or proceeds to the subsequent base without editing."""
 import time
 
-import RNA
 import numpy as np
-import pandas as pd
 from edit_node import EditNodeRoot, EditNodeChild
-from run_settings import bulk_cofold, sequences_to_progress, min_mfe_to_progress
+from docking import cofold_all
+from run_settings import bulk_cofold, sequences_to_progress, min_mfe_to_progress, graph_edit_trees
 from type_definitions import NodeType
 from graph_gen import graph_edit_tree
 from sequence_import import Sequence
 from concurrent.futures import ProcessPoolExecutor
-import multiprocessing as mp
-import os
-from functools import lru_cache
+from collections import defaultdict
+from operator import attrgetter
+
+
+# pairs of actions (matching node, node being tested) whose nodes may be merged when their sequences match. Held as
+# tuples so that each check is a single hash lookup without building a new string
+mergeable_actions = frozenset({('d', 'd'), ('i', 'p'), ('p', 'i'), ('i', 'i'), ('p', 'p')})
+
+k = 1.986e-3  # boltzmann constant, kcal/(mol.K)
+T = 310  # mammalian body temperature, K
+kT = k * T  # thermal energy used to convert MFEs to Boltzmann probabilities, kcal/mol
 
 
 class EditTree:
     """Contains all edit nodes for a single guide RNA's series of edits."""
 
+    # the attributes of an edit tree are fixed, so they are stored in slots rather than a per-instance dict. Any new
+    # attribute must be added here
+    __slots__ = ('guide_node', 'id', 'guide_sequence', 'init_gIndex', 'init_sequence', 'init_dock_idx', 'init_mIndex',
+                 'root', 'edit_nodes_all', 'edit_nodes_next', 'edit_levels', 'is_complete', 'progressed_nodes')
+
     def __init__(self, guide_node):
         # print('Edit tree initiated.')
         self.guide_node = guide_node
@@ -53,18 +65,18 @@ class EditTree:
 
         self.progressed_nodes = self.select_progressed_nodes()
         # self.graph =
-        graph_edit_tree(self)
+        if graph_edit_trees:
+            graph_edit_tree(self)
 
     def calc_probabilities(self, nodes_list) -> None:
         """Calls the cofold_sequence function for each node provided, then calculates the probabilities for all."""
 
-        k = 1.986e-3  # boltzmann constant, kcal/(mol.K)
-        T = 310  # mammalian body temperature, K
-
         if bulk_cofold:
             working_nodes = [edit_node for edit_node in nodes_list if edit_node.node_type is NodeType.COMPLETE]
         else:
-            working_nodes = sorted(nodes_list)
+            # keyed on the same value as EditNode.__lt__, so the C-level sort doesn't call back into Python for
+            # every comparison
+            working_nodes = sorted(nodes_list, key=attrgetter('edit_level'))
 
         # print(f'Number of nodes to cofold: {len(working_nodes)}')
 
@@ -76,40 +88,55 @@ class EditTree:
         #     working_nodes = executor.map(cofold_sequence_func, working_nodes)
         # mfes = [edit_node.mfe for edit_node in working_nodes]
 
-        if len(working_nodes) > 10_000:
-            # multiprocessing option 2
-            mfes = []
-            cofold_sequences = [node.cofold_string for node in working_nodes]
-            with mp.Pool(processes=os.cpu_count() - 1) as p:
-                cofold_results = p.map(RNA.cofold, cofold_sequences)
+        # multiprocessing option 2
+        # nodes that can't reuse their parent's result are co-folded as a single batch. Each distinct cofold string is
+        # only folded once, with large batches spread across the shared process pool
+        unfolded_nodes = [edit_node for edit_node in working_nodes if not edit_node.reuse_parent_cofold()]
+        cofold_results = cofold_all([edit_node.cofold_string for edit_node in unfolded_nodes])
 
-                # mfe_min = min([result[1] for result in cofold_results])
+        for edit_node, cofold_result in zip(unfolded_nodes, cofold_results):
+            edit_node.alignment, edit_node.mfe = cofold_result
 
-                for node, cofold_result in zip(working_nodes, cofold_results):
-                    node.alignment, node.mfe = cofold_result
-                    mfes.append((node.mfe))
-        else:
-            # single core option
-            mfes = [edit_node.cofold_sequence() for edit_node in working_nodes]
+        mfes = np.array([edit_node.mfe for edit_node in working_nodes], dtype=np.float64)
+
+        mfe_min = mfes.min()
 
-        mfe_min = min(mfes)
+        # highest downstream 'probability' result of each node visited, shared by all starting nodes of this call so
+        # that merged sub-trees are only visited once
+        downstream_probs = {}
 
-        @lru_cache()
-        def max_downstream_prob(node) -> float:
-            """Recursive determination of the highest downstream 'probability' result."""
+        def max_downstream_prob(start_node) -> float:
+            """Iterative, depth-first determination of the highest downstream 'probability' result. A node's result
+            is only calculated once the results of all its children are known."""
 
-            best_probability = node.probability
-            for child in node.children:
-                child_probability = max_downstream_prob(child)
-                if child_probability > best_probability:
-                    best_probability = child_probability
+            stack = [start_node]
+            while stack:
+                node = stack[-1]
+                if node in downstream_probs:
+                    stack.pop()
+                    continue
 
-            return best_probability
+                pending_children = [child for child in node.children if child not in downstream_probs]
+                if pending_children:
+                    stack += pending_children
+                    continue
+
+                stack.pop()
+                best_probability = node.probability
+                for child in node.children:
+                    child_probability = downstream_probs[child]
+                    if child_probability > best_probability:
+                        best_probability = child_probability
+                downstream_probs[node] = best_probability
+
+            return downstream_probs[start_node]
 
         # Option 1
-        # Calculate the probability for all nodes of the current level
-        for edit_node in working_nodes:
-            edit_node.probability = np.exp((mfe_min - edit_node.mfe) / (k * T))
+        # Calculate the probability for all nodes of the current level in a single array operation
+        # converted to Python floats, so that NumPy scalars aren't stored on the nodes (and written to the csv files)
+        probabilities = np.exp((mfe_min - mfes) / kT).tolist()
+        for edit_node, probability in zip(working_nodes, probabilities):
+            edit_node.probability = probability
 
         # split out the 'probability_product' calculation to enable the upgrading of 'probability' value
         # if a node has a downstream node with a higher 'probability' result
@@ -210,19 +237,16 @@ class EditTree:
     #
     #     return merge_node
 
-    def get_match_indices(self, node_list, search_item):
-        """Gets a list of indices where the item in a list matches an item being searched for."""
+    @staticmethod
+    def index_sequences(sequences: list) -> defaultdict:
+        """Maps each sequence to the list of indices (ascending) at which it appears in the given list, so that all
+        matches for a sequence are found with a single lookup."""
+
+        sequence_indices = defaultdict(list)
+        for idx, sequence in enumerate(sequences):
+            sequence_indices[sequence].append(idx)
 
-        indices_list = []
-        start_index = 0
-        while True:
-            try:
-                match_index = node_list[start_index:].index(search_item)
-                indices_list.append(start_index + match_index)
-                start_index = indices_list[-1] + 1
-            except ValueError:
-                # print(f'Matching indices: {indices_list}')
-                return indices_list
+        return sequence_indices
 
     def grow_tree(self):
         """Extending the edit tree by a single step along the guide RNA."""
@@ -235,31 +259,38 @@ class EditTree:
         else:
             current_index_nodes = [node for node in self.edit_nodes_next]
 
+        # each node's sequence string is read once per round, with the subsets below taken alongside their nodes
         current_index_sequences = [node.sequence.seq for node in current_index_nodes]
 
         # if the edit node has the action 'delete' or is the root node then its children will have the same mRNA
         # index. Therefore, these will need to be generated and included in the same round of mfe determination
         # and probability calculation
         del_nodes = [node for node in current_index_nodes if node.action == 'd']
-        del_sequences = [node.sequence.seq for node in del_nodes]
+        del_sequences = [sequence for node, sequence in zip(current_index_nodes, current_index_sequences)
+                         if node.action == 'd']
 
         # NEWER METHOD
         same_idx_c_nodes = []
         while del_nodes:
-            del_nodes_unchecked = del_nodes
-            del_sequences_unchecked = del_sequences
+            del_sequence_indices = self.index_sequences(del_sequences)
 
+            # nodes are tested from the end of the list. Indices already tested, or merged into an earlier test node,
+            # are recorded rather than removed from the list, so that the indexed positions remain valid
+            checked_indices = set()
             del_nodes_checked = []
-            while del_nodes_unchecked:
-                test_node = del_nodes_unchecked.pop()
-                test_sequence = del_sequences_unchecked.pop()
+            for test_idx in reversed(range(len(del_nodes))):
+                if test_idx in checked_indices:
+                    continue
+                checked_indices.add(test_idx)
+                test_node = del_nodes[test_idx]
 
-                matching_indices = self.get_match_indices(node_list=del_sequences_unchecked, search_item=test_sequence)
                 nodes_to_merge = []
-                for idx in reversed(matching_indices):
-                    if del_nodes_unchecked[idx].action + test_node.action in ('dd', 'ip', 'pi', 'ii', 'pp'):
-                        del del_sequences_unchecked[idx]
-                        confirmed_match = del_nodes_unchecked.pop(idx)
+                for idx in reversed(del_sequence_indices[del_sequences[test_idx]]):
+                    if idx in checked_indices:
+                        continue
+                    if (del_nodes[idx].action, test_node.action) in mergeable_actions:
+                        checked_indices.add(idx)
+                        confirmed_match = del_nodes[idx]
                         nodes_to_merge.append(confirmed_match)
                         confirmed_match.to_merge = True
                         confirmed_match.merge_siblings = nodes_to_merge
@@ -289,22 +320,25 @@ class EditTree:
             del_nodes = same_idx_d_nodes
             del_sequences = [node.sequence.seq for node in del_nodes]
 
+        same_idx_c_sequences = [node.sequence.seq for node in same_idx_c_nodes]
         c_nodes_unchecked = [node for node in same_idx_c_nodes if node.node_type is not NodeType.MERGED]
-        c_sequences_unchecked = [node.sequence.seq for node in c_nodes_unchecked]
+        c_sequences_unchecked = [sequence for node, sequence in zip(same_idx_c_nodes, same_idx_c_sequences)
+                                 if node.node_type is not NodeType.MERGED]
 
         current_index_nodes += same_idx_c_nodes
-        current_index_sequences += [node.sequence.seq for node in same_idx_c_nodes]
+        current_index_sequences += same_idx_c_sequences
+        current_sequence_indices = self.index_sequences(current_index_sequences)
 
         while c_nodes_unchecked:
             test_node = c_nodes_unchecked.pop()
             test_sequence = c_sequences_unchecked.pop()
 
-            matching_indices = self.get_match_indices(node_list=current_index_sequences, search_item=test_sequence)
+            matching_indices = current_sequence_indices[test_sequence]
             nodes_to_merge = []
             previously_identified = []
             already_merged = False
             for idx in reversed(matching_indices):
-                if current_index_nodes[idx].action + test_node.action in ('dd', 'ip', 'pi', 'ii', 'pp'):
+                if (current_index_nodes[idx].action, test_node.action) in mergeable_actions:
                     confirmed_match = current_index_nodes[idx]
                     if confirmed_match.to_merge:
                         previously_identified.append(confirmed_match)
@@ -561,18 +595,24 @@ class EditTree:
         # upper limit, set out as 'sequences_to_progress' in the 'run_settings' module
         number_to_progress = min(sequences_to_progress, len(complete_nodes))
 
-        # create a list of dicts, where each dict contains the full list of variables for each complete_node
-        comp_vars = [vars(node) for node in complete_nodes]
-        # the list of dicts is used to make a DataFrame, enabling simple, multi-parameter sorting
-        comp_df = pd.DataFrame(comp_vars)
-        comp_df = comp_df[comp_df['mfe'] < min_mfe_to_progress]
-
-        ranked = comp_df.sort_values(by=['probability_product', 'mfe', 'mismatches', 'gIndex', 'edit_level'],
-                                     ascending=[False, True, True, False, True])
-        # original index is replaced by the ranked index. The ranked index is used to select the top n edit_nodes.
-        # The original index of these selected edit nodes can then be used to retrieve the edit_nodes from the
-        # 'complete_nodes' list, since its index matches the original DataFrame index
-        candidate_indices = ranked.reset_index(drop=False).iloc[:number_to_progress]['index']
+        # only the five ranking values are gathered for each complete_node, as arrays in the order of 'complete_nodes'
+        probability_products = np.array([node.probability_product for node in complete_nodes], dtype=np.float64)
+        mfes = np.array([node.mfe for node in complete_nodes], dtype=np.float64)
+        mismatches = np.array([node.mismatches for node in complete_nodes], dtype=np.int64)
+        gIndices = np.array([node.gIndex for node in complete_nodes], dtype=np.int64)
+        edit_levels = np.array([node.edit_level for node in complete_nodes], dtype=np.int64)
+
+        below_minimum = np.flatnonzero(mfes < min_mfe_to_progress)
+
+        # with no more than one candidate there is nothing to rank
+        if below_minimum.size <= 1:
+            candidate_indices = below_minimum
+        else:
+            # lexsort is stable and treats its last key as the primary key. Descending criteria are negated. The
+            # ranked positions are then used to retrieve the original indices of the edit_nodes in 'complete_nodes'
+            ranked = np.lexsort((edit_levels[below_minimum], -gIndices[below_minimum], mismatches[below_minimum],
+                                 mfes[below_minimum], -probability_products[below_minimum]))
+            candidate_indices = below_minimum[ranked[:number_to_progress]]
 
         # chosen edit_nodes are selected and placed in a new 'progressed_nodes' list, which is then returned
         progressed_nodes = []
@@ -1,124 +1,191 @@
 """Generates the graphviz outputs for guide trees and edit trees."""
 
 
+import os
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import graphviz as gv
+from graphviz.quoting import quote, quote_edge
 from pathlib import Path
 from type_definitions import NodeType
+from outputs_gen import make_parent_dir
 from run_settings import maximum_edit_graph_nodes
+import numpy as np
 
 
-def produce_match_string(edit_node) -> str:
-    """Creates a combined string of pre- and post-edit sequences, paired with the guide sequence."""
+mismatch_set = {'gg', 'cc', 'aa', 'uu', 'ga', 'ag', 'ac', 'ca', 'cu', 'uc'}
+wobble_set = {'gu', 'ug'}
+
+# symbol shown between each mRNA base (row) and guide base (column), indexed by their ASCII codes. Both cases are
+# filled in since the current base of each trimmed sequence is upper case. A space in the guide (padding past its
+# end) always gives a space
+match_symbol_table = np.full((128, 128), ord('|'), dtype=np.uint8)
+for pair_set, symbol in ((mismatch_set, '.'), (wobble_set, 'o')):
+    for pair in pair_set:
+        for b1 in (pair[0], pair[0].upper()):
+            for b2 in (pair[1], pair[1].upper()):
+                match_symbol_table[ord(b1), ord(b2)] = ord(symbol)
+match_symbol_table[:, ord(' ')] = ord(' ')
+del pair_set, symbol, pair, b1, b2
+
+# graph styling. The edit tree colour schemes are indexed from 0, edit actions by their letter, and the guide tree
+# edge styles by guide number - 1, with guide numbers above 6 sharing the final style
+colourschemes = ('bupu', 'purd', 'pubu', 'bugn', 'blues', 'greys', 'oranges', 'purples', 'reds')
+action_colours = {'p': 'blue', 'd': 'red', 'i': 'green'}
+edge_shapes = ('normal', 'box', 'curve', 'dot', 'inv', 'tee')
+edge_colours = ('green', 'gold', 'blue', 'hotpink', 'black', 'azure4')
+
+# graphs are rendered by the external 'dot' program, so renders are handed to a shared thread pool and the tree
+# building carries on while 'dot' runs
+render_threads = max(os.cpu_count() - 1, 1)
+render_executor = None
+pending_renders = []
+
+
+def wait_for_renders() -> None:
+    """Waits for all submitted graph renders to finish. Any error raised by a render is raised here."""
+
+    while pending_renders:
+        pending_renders.pop(0).result()
+
+
+def close_render_executor() -> None:
+    """Waits for outstanding renders and shuts down the shared render thread pool, if started."""
+
+    global render_executor
+    if render_executor is not None:
+        try:
+            wait_for_renders()
+        finally:
+            render_executor.shutdown(wait=True)
+            render_executor = None
+
+
+def render_graph(graph: gv.Digraph, dest_addr: Path) -> None:
+    """Submits the graph to be rendered to 'dest_addr' in the background. The thread pool is started on first use
+    and closed when the program exits."""
+
+    global render_executor
+    if render_executor is None:
+        render_executor = ThreadPoolExecutor(max_workers=render_threads)
+        atexit.register(close_render_executor)
 
-    mismatch_set = {'gg', 'cc', 'aa', 'uu', 'ga', 'ag', 'ac', 'ca', 'cu', 'uc'}
+    pending_renders.append(render_executor.submit(graph.render, str(dest_addr), view=False))
+
+
+# maps the ASCII code of each lower case letter to that of its upper case form, leaving all other codes unchanged
+upper_case_table = np.arange(128, dtype=np.uint8)
+upper_case_table[ord('a'):ord('z') + 1] -= ord('a') - ord('A')
+
+length_lead = 3
+length_trail = 4
+
+
+def trim_around_index(seq_array: np.ndarray, index: int) -> np.ndarray:
+    """Takes the bases either side of the index from a sequence array, with the base at the index in upper case.
+    Slicing follows the same rules as for the sequence string."""
+
+    return np.concatenate((seq_array[index - length_lead:index],
+                           upper_case_table[seq_array[[index]]],
+                           seq_array[index + 1:index + length_trail]))
+
+
+def compare_sequences(b1: np.ndarray, b2: np.ndarray) -> np.ndarray:
+    """Produces the array of pairing symbols between two sequence arrays. As with zip, the result is the length of the
+    shorter sequence."""
+
+    length = min(b1.size, b2.size)
+
+    return match_symbol_table[b1[:length], b2[:length]]
+
+
+def produce_match_string(edit_node) -> str:
+    """Creates a combined string of pre- and post-edit sequences, paired with the guide sequence. Each row is built
+    as a uint8 array from the sequences' cached arrays and only decoded when the rows are joined."""
 
     current_m_idx = edit_node.mIndex
     current_g_idx = edit_node.gIndex
-    prior_m_seq = edit_node.init_sequence.seq
-    post_m_seq = edit_node.sequence.seq
-    g_seq = edit_node.guide.seq
-
-    length_lead = 3
-    length_trail = 4
-
-    trimmed_prior_m_seq = f'{prior_m_seq[current_m_idx - length_lead:current_m_idx]}' \
-                          f'{prior_m_seq[current_m_idx].upper()}' \
-                          f'{prior_m_seq[current_m_idx + 1:current_m_idx + length_trail]}'
-    trimmed_post_m_seq = f'{post_m_seq[current_m_idx - length_lead:current_m_idx]}' \
-                         f'{post_m_seq[current_m_idx].upper()}' \
-                         f'{post_m_seq[current_m_idx + 1:current_m_idx + length_trail]}'
-    trimmed_g_seq = f'{g_seq[current_g_idx - length_lead:current_g_idx]}' \
-                    f'{g_seq[current_g_idx].upper()}' \
-                    f'{g_seq[current_g_idx + 1:current_g_idx + length_trail]}'
-
-    if len(trimmed_g_seq) < len(trimmed_post_m_seq):
-        missing = len(trimmed_post_m_seq) - len(trimmed_g_seq)
-        filler = missing * ' '
-        trimmed_g_seq = f'{trimmed_g_seq}{filler}'
-
-    def compare_sequences(s1, s2):
-        match_string = ''
-        for b1, b2 in zip(s1, s2):
-            if b2 == ' ':
-                result = ' '
-            else:
-                pair = (b1 + b2).lower()
-                if pair in mismatch_set:
-                    result = '.'
-                else:
-                    if pair in {'gu', 'ug'}:
-                        result = 'o'
-                    else:
-                        result = '|'
-            match_string = match_string + result
-        return match_string
+
+    trimmed_prior_m_seq = trim_around_index(edit_node.init_sequence.seq_array, current_m_idx)
+    trimmed_post_m_seq = trim_around_index(edit_node.sequence.seq_array, current_m_idx)
+    trimmed_g_seq = trim_around_index(edit_node.guide.seq_array, current_g_idx)
+
+    if trimmed_g_seq.size < trimmed_post_m_seq.size:
+        filler = np.full(trimmed_post_m_seq.size - trimmed_g_seq.size, ord(' '), dtype=np.uint8)
+        trimmed_g_seq = np.concatenate((trimmed_g_seq, filler))
 
     prior_match = compare_sequences(trimmed_prior_m_seq, trimmed_g_seq)
     post_match = compare_sequences(trimmed_post_m_seq, trimmed_g_seq)
 
-    compound_string = f'{trimmed_prior_m_seq}\n{prior_match}\n{trimmed_g_seq}\n{post_match}\n{trimmed_post_m_seq}'
+    rows = (trimmed_prior_m_seq, prior_match, trimmed_g_seq, post_match, trimmed_post_m_seq)
+    compound_string = b'\n'.join(row.tobytes() for row in rows).decode('ascii')
 
     return compound_string
 
 
-def graph_edit_tree(edit_tree) -> gv.Digraph:
-    """Produces dot format Diagraph from the input list of edit nodes."""
+def create_edit_node_text(edit_node) -> str:
+    """Produces text content for nodes in the tree graph. Defined at module level so that it isn't rebuilt as a
+    closure on every call to 'graph_edit_tree'."""
+
+    if not edit_node.parent:
+        return 'Root Node'
+
+    # only the mismatches, probabilities, and match string are shown on each node. Further labels can be added to
+    # the joined lines below when inspecting a tree, e.g.:
+    # dock = f'Dock: {edit_node.edit_tree.guide_node.init_dock_idx}'
+    # id = f'ID: {edit_node.id}'
+    # action_log = f'Action log: {edit_node.action_log[-5:]}'
+    # type = f'Node Type: {edit_node.node_type}'
+    # gIdx = f'Guide Index: {edit_node.gIndex}'
+    # mIdx = f'Seq Index: {edit_node.mIndex}'
+    # action = f'Action: {edit_node.action}'
+    # mfe = f'MFE: {edit_node.mfe: 0.5f}'
+    # align = edit_node.alignment
+    # seq_pre = f'Seq init: {edit_node.init_sequence.seq[edit_node.mIndex - 5:edit_node.mIndex + 5]}'
+    # seq_post = f'Seq pos: {edit_node.sequence.seq[edit_node.mIndex - 5:edit_node.mIndex + 5]}'
+    # guide = f'gSeq: {edit_node.guide.seq[edit_node.edit_tree.init_gIndex:]}'
+    # most nodes in a tree are never co-folded and so have no probabilities. This is checked for directly, since
+    # raising and catching an AttributeError for each of them is far slower
+    if hasattr(edit_node, 'probability') and hasattr(edit_node, 'probability_product'):
+        prob = f'Prob {edit_node.probability:0.3f}'
+        prob_prod = f'Prob_prod: {edit_node.probability_product:0.3f}'
+    else:
+        prob = 'Probability not calculated'
+        prob_prod = 'Probability (Product) not calculated'
+    mismatches = f'Mismatches: {edit_node.mismatches}'
+    match = produce_match_string(edit_node=edit_node)
+
+    text = '\n'.join((mismatches, prob, prob_prod, match))
+
+    return text
 
-    guide_tree = edit_tree.guide_node.guide_tree
-    level = f'Level_{edit_tree.guide_node.guide_level:03d}'
 
-    file_name = Path(f'edit_tree_{edit_tree.id}')
-    dest_addr = guide_tree.log_path.parent / guide_tree.id / level / edit_tree.guide_node.id / file_name
-    dest_addr.parent.mkdir(parents=True, exist_ok=True)
-    graph = gv.Digraph(engine='dot', format='svg')
+def graph_edit_tree(edit_tree) -> gv.Digraph:
+    """Produces dot format Diagraph from the input list of edit nodes."""
 
     all_nodes = edit_tree.edit_nodes_all
 
+    # the node total is checked before any directories or graph objects are created
+    if not all_nodes:
+        return None
     if len(all_nodes) > maximum_edit_graph_nodes:
         print('Edit node total exceeds acceptable graphable threshold. No edit tree graph generated.')
         return None
 
-    def create_edit_node_text(edit_node) -> str:
-        """Produces text content for nodes in the tree graph."""
-
-        # if edit_node.node_type is NodeType.ROOT:
-        dock = f'Dock: {edit_node.edit_tree.guide_node.init_dock_idx}'
-        id = f'ID: {edit_node.id}'
-        action_log = f'Action log: {edit_node.action_log[-5:]}'
-        type = f'Node Type: {edit_node.node_type}'
-        gIdx = f'Guide Index: {edit_node.gIndex}'
-        mIdx = f'Seq Index: {edit_node.mIndex}'
-        action = f'Action: {edit_node.action}'
-        try:
-            mfe = f'MFE: {edit_node.mfe: 0.5f}'
-            align = edit_node.alignment
-            prob = f'Prob {edit_node.probability:0.3f}'
-            prob_prod = f'Prob_prod: {edit_node.probability_product:0.3f}'
-        except AttributeError:
-            mfe = f'MFE not calculated'
-            align = 'No alignment'
-            prob = f'Probability not calculated'
-            prob_prod = f'Probability (Product) not calculated'
-        mismatches = f'Mismatches: {edit_node.mismatches}'
-        # mismatches_full = f'Mismatches (f): {node.mismatches_full}'
-        seq_pre = f'Seq init: {edit_node.init_sequence.seq[edit_node.mIndex - 5:edit_node.mIndex + 5]}'
-        seq_post = f'Seq pos: {edit_node.sequence.seq[edit_node.mIndex - 5:edit_node.mIndex + 5]}'
-        guide = f'gSeq: {edit_node.guide.seq[edit_node.edit_tree.init_gIndex:]}'
-        # pairs = f'Pairs: {node.pairs}'
-        match = produce_match_string(edit_node=edit_node)
-
-        if edit_node.parent:
-            text = f'{mismatches}\n{prob}\n{prob_prod}\n{match}'
-        else:
-            text = 'Root Node'
+    guide_tree = edit_tree.guide_node.guide_tree
+    level = f'Level_{edit_tree.guide_node.guide_level:03d}'
 
-        return text
+    file_name = f'edit_tree_{edit_tree.id}'
+    dest_addr = guide_tree.log_path.parent / guide_tree.id / level / edit_tree.guide_node.id / file_name
+    make_parent_dir(guide_tree, dest_addr)
+    graph = gv.Digraph(engine='dot', format='svg')
 
-    colourschemes = {0: 'bupu', 1: 'purd', 2: 'pubu', 3: 'bugn', 4: 'blues', 5: 'greys', 6: 'oranges',
-                     7: 'purples', 8: 'reds'}
     scheme = colourschemes[0]
     graph.attr('node', style='filled', fontname='monospace', colorscheme=scheme + str(2 + 2))
 
+    # the DOT lines are built here and added to the graph body in one go, rather than through a 'graph.attr' and a
+    # 'graph.node' call per node. The lines are identical to those the Digraph methods would produce
+    node_lines = []
     for node in all_nodes:
         node_text = create_edit_node_text(node)
         # sets colour of node by its number of mismatches
@@ -135,8 +202,10 @@ def graph_edit_tree(edit_tree) -> gv.Digraph:
         # else:
         #     text_colour = 'black'
         # graph.attr('node', shape=node_shape, fontcolor = text_colour, fillcolor = colour)
-        graph.attr('node', shape=node_shape, fillcolor=str(min(int(node.mismatches), 2 + 1) + 1))
-        graph.node(str(node.id), node_text)
+        node_colour = str(min(int(node.mismatches), 2 + 1) + 1)
+        node_lines.append(f'\tnode [fillcolor={quote(node_colour)} shape={node_shape}]\n')
+        node_lines.append(f'\t{quote(str(node.id))} [label={quote(node_text)}]\n')
+    graph.body.extend(node_lines)
 
     # # adds edge for each parent-child pair, even if the child has multiple parents
     # for node in all_nodes:
@@ -148,16 +217,17 @@ def graph_edit_tree(edit_tree) -> gv.Digraph:
     #             graph.edge(tail_name=parent.action_log, head_name=node.action_log)
 
 
+    edge_lines = []
     for parent in all_nodes:
         # tail_name = parent, head_name = child
         for child in parent.children:
-            actions = {'p': 'blue', 'd': 'red', 'i': 'green'}
-            colour = actions[child.action]
-            graph.edge(tail_name=parent.id, head_name=child.id, color=colour)
+            colour = action_colours[child.action]
+            edge_lines.append(f'\t{quote_edge(parent.id)} -> {quote_edge(child.id)} [color={colour}]\n')
+    graph.body.extend(edge_lines)
 
     graph.attr('edge', style='solid')
 
-    graph.render(str(dest_addr), view=False)
+    render_graph(graph, dest_addr)
 
     return graph
 
@@ -165,28 +235,19 @@ def graph_guide_tree(guide_tree):
     """Produces dot format Diagraph from the input list of nodes. Outputs a txt file detailing the and the
      node ediges and a pdf containing the graph itself."""
 
-    dest_addr = guide_tree.log_path.parent / Path(guide_tree.id) / Path('guide_tree')
-    dest_addr.parent.mkdir(parents=True, exist_ok=True)
-    graph = gv.Digraph(engine='dot')
-
     all_nodes = guide_tree.guide_nodes_all
 
+    if not all_nodes:
+        return None
+
+    dest_addr = guide_tree.log_path.parent / guide_tree.id / 'guide_tree'
+    make_parent_dir(guide_tree, dest_addr)
+    graph = gv.Digraph(engine='dot')
+
     def create_guide_node_text(guide_node) -> str:
         """Produces text content for nodes in the guide tree graph."""
 
         init_dock_idx = guide_node.duplex[1]
-        init_sequence = guide_node.duplex[2]
-        prog_sequences_dict = guide_node.progressed_sequences
-        if prog_sequences_dict:
-            prog_count = len(prog_sequences_dict)
-        else:
-            prog_count = 'None'
-        prog_seqs = ''
-        if prog_sequences_dict:
-            for i, (seq, idx) in enumerate(prog_sequences_dict):
-                prog_seqs = prog_seqs + f'{i}: {seq.seq[:idx]}\n'
-            else:
-                prog_seqs = 'None'
 
         id_split = guide_node.id.split('-')[0].split('_')
         id = f'{id_split[0]}\n{id_split[1]}\n{id_split[4]}'
@@ -194,23 +255,26 @@ def graph_guide_tree(guide_tree):
         # gIdx = f'Guide Index: {guide_node.gIndex}'
         dock_idx = f'Dock Index: {init_dock_idx}'
         # mIdx = f'Seq Index: {init_mIndex}'
-        guide = f'{guide_node.guide_name}'
-        progressed_count = f'Progressed: {prog_count}'
-        progressed_seqs = f'Progressed sequences:\n{prog_seqs}'
+        # guide = f'{guide_node.guide_name}'
+        # progressed_count = f'Progressed: {len(guide_node.progressed_sequences)}'
         # action = f'Action: {guide_node.action}'
         # prob_prod = f'Probability: {node.probability_product:0.4f}'
         # mismatches = f'Mismatches: {guide_node.mismatches}'
         # mismatches_full = f'Mismatches (f): {node.mismatches_full}'
-        seq_pre = f'Seq init: {guide_node.duplex[2].seq[init_dock_idx:init_dock_idx + 40]}'
+        # seq_pre = f'Seq init: {guide_node.duplex[2].seq[init_dock_idx:init_dock_idx + 40]}'
         # seq_post = f'Seq pos: {guide_node.sequence.seq[15:30]}'
         # guide = f'gSeq: {guide_node.guide.seq[guide_node.edit_tree.init_gIndex:]}'
-        tot_err = f'Errors in progressed: {guide_node.errors_accumulated}'
-
-        text = f'{id}\n{dock_idx}\n{tot_err}'
+        text = f'{id}\n{dock_idx}'
+        # errors are only counted against the known edited sequence in QC runs
+        if guide_node.errors_accumulated is not None:
+            tot_err = f'Errors in progressed: {guide_node.errors_accumulated}'
+            text = f'{text}\n{tot_err}'
 
         return text
 
     graph.attr('node', style='filled')
+    # as in 'graph_edit_tree', the DOT lines are collected and added to the graph body together
+    node_lines = []
     for node in all_nodes:
         init_dock_idx = node.duplex[1]
         init_sequence = node.duplex[2]
@@ -234,27 +298,27 @@ def graph_guide_tree(guide_tree):
         if node.correct_dock:
             colour = 'green'
 
-        graph.attr('node', shape='ellipse', fillcolor=colour)
-        graph.node(str(node.id), node_text)
+        node_lines.append(f'\tnode [fillcolor={quote(colour)} shape=ellipse]\n')
+        node_lines.append(f'\t{quote(str(node.id))} [label={quote(node_text)}]\n')
+    graph.body.extend(node_lines)
 
     # adds edge for each parent-child pair, even if the child has multiple parents
+    edge_lines = []
     for node in all_nodes:
         # if node.parent:
-        shapes = {1: 'normal', 2: 'box', 3: 'curve', 4: 'dot', 5: 'inv', 6: 'tee'}
-        colors = {1: 'green', 2: 'gold', 3: 'blue', 4: 'hotpink', 5: 'black', 6: 'azure4'}
 
         seq_num = node.seq_num
 
         for child in node.children:
             guide_num = child.guide_num
-            graph.attr('edge', arrowhead=shapes[1], color=colors[min(guide_num, 6)])
+            edge_lines.append(f'\tedge [arrowhead={edge_shapes[0]} color={edge_colours[min(guide_num, 6) - 1]}]\n')
             # tail_name = parent, head_name = child
-            graph.edge(label=child.g_name_short,
-                       tail_name=node.id,
-                       head_name=child.id)
+            edge_lines.append(f'\t{quote_edge(node.id)} -> {quote_edge(child.id)} '
+                              f'[label={quote(child.g_name_short)}]\n')
+    graph.body.extend(edge_lines)
 
     graph.attr('edge', style='solid')
 
-    graph.render(str(dest_addr), view=False)
+    render_graph(graph, dest_addr)
 
     return graph
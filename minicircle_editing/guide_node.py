@@ -3,14 +3,12 @@ interaction and all the edits that this produces."""
 
 
 import numpy as np
-import uuid
-
-import pandas as pd
 import time
 
 from docking import select_guides
 from edit_trees import EditTree
 from run_settings import editing_window, short_sequence_editing, max_anchor, max_grnas_subsequent, min_grnas_subsequent
+from run_settings import qc_mode
 from sequence_import import Sequence
 from outputs_gen import save_edit_tree
 from type_definitions import OutputNodes
@@ -29,11 +27,12 @@ class GuideNode:
 
         if self.parent:
             self.guide_tree = self.parent.guide_tree
-            self.prev_guides = self.parent.prev_guides + [self.parent.guide_name]
+            # kept as a tuple so that each child's copy is a single small allocation
+            self.prev_guides = self.parent.prev_guides + (self.parent.guide_name,)
             self.guide_level = self.parent.guide_level + 1
         else:
             self.guide_tree = guide_tree
-            self.prev_guides = []
+            self.prev_guides = ()
             self.guide_level = 1
             self.node_number = 1
 
@@ -47,7 +46,8 @@ class GuideNode:
         self.init_gIndex = self.duplex[3]
 
         self.g_name_short = self.guide_name.split('_')[1]
-        self.id = f'{self.g_name_short}_L{self.guide_level:02d}_S{seq_num:02d}_G{guide_num:02d}_{uuid.uuid4()}'
+        node_count = next(self.guide_tree.guide_node_ids)
+        self.id = f'{self.g_name_short}_L{self.guide_level:02d}_S{seq_num:02d}_G{guide_num:02d}_{node_count:06d}'
         self.output_path = self.guide_tree.log_path.parent / f'{self.guide_tree.id}' \
                                                              f'/Level_{self.guide_level:03d}/{self.id}'
 
@@ -95,7 +95,11 @@ class GuideNode:
             self.cache_outputs()
 
         self.reassemble_sequence()
-        self.errors_accumulated = self.total_errors()
+        # errors against the known edited sequence are only counted for QC runs
+        if qc_mode:
+            self.errors_accumulated = self.total_errors()
+        else:
+            self.errors_accumulated = None
 
     def gen_children(self):
         """Generates child guide nodes for each of the sequences that meet the criteria for progression."""
@@ -112,49 +116,74 @@ class GuideNode:
                 self.guide_tree.existing_children_uses += 1
             else:
                 duplexes, docked_guides_df = select_guides(
-                    messenger=sequence, previous_guides=self.prev_guides + [self.guide_name],
+                    messenger=sequence, previous_guides=self.prev_guides + (self.guide_name,),
                     guides_dict=self.guide_tree.guides_dict, current_mIndex=mIndex - max_anchor
                 )
                 if len(docked_guides_df):
                     docked_guides_df.to_csv(self.output_path / f'docked_guides_s{si:02d}')
 
+                # the number of correctly docked children is counted once, then kept up to date as children are added
+                progressed_count = sum([1 for child in self.children if child.correct_dock])
                 for gi, duplex in enumerate(duplexes):
                     # generate child nodes for the minimum number of guides to consider.
-                    progressed_count = sum([1 for child in self.children if child.correct_dock])
-                    conditions = (gi < min_grnas_subsequent) | ((gi < max_grnas_subsequent) & (progressed_count == 0))
-                    if conditions:
-                    # if True:
-                        new_guide_node = GuideNode(init_duplex=duplex, parent=self, seq_num=si + 1, guide_num=gi + 1)
-                        self.children.append(new_guide_node)
-                        new_guide_init_seq = pd.Series(data=new_guide_node.init_sequence.seq)
-                        self.guide_tree.guide_nodes_series = self.guide_tree.guide_nodes_series.append(
-                            new_guide_init_seq, ignore_index=True)
-                        self.guide_tree.guide_nodes_all.append(new_guide_node)
+                    conditions = ((gi < min_grnas_subsequent)
+                                  or ((gi < max_grnas_subsequent) and (progressed_count == 0)))
+                    # gi only increases and progressed_count never decreases, so once the conditions fail they fail
+                    # for all remaining duplexes
+                    if not conditions:
+                        break
+                    new_guide_node = GuideNode(init_duplex=duplex, parent=self, seq_num=si + 1, guide_num=gi + 1)
+                    self.children.append(new_guide_node)
+                    if new_guide_node.correct_dock:
+                        progressed_count += 1
+                    self.guide_tree.guide_nodes_by_sequence.setdefault(
+                        new_guide_node.init_sequence.seq, []).append(new_guide_node)
+                    self.guide_tree.guide_nodes_all.append(new_guide_node)
 
         self.child_generation_investigated = True
 
 
+    def saved_state(self) -> dict:
+        """The guide node's own results, for saving to disk. References to other objects (the guide tree, parents,
+        children, and the edit tree) are replaced by ids or paths, and Sequence objects by their sequence strings, so
+        that saving a node doesn't walk the whole tree."""
+
+        node_vars = vars(self)
+
+        return {'id': self.id,
+                'guide_name': self.guide_name,
+                'guide_level': self.guide_level,
+                'node_number': node_vars.get('node_number'),
+                'guide_tree_id': self.guide_tree.id,
+                'parent_ids': [parent.id for parent in self.parents if parent],
+                'children_ids': [child.id for child in self.children],
+                'cache_key': self.cache_key(),
+                'progressed_sequences': [(sequence.seq, mIndex) for sequence, mIndex in self.progressed_sequences],
+                'edit_tree_path': node_vars.get('edit_tree_path'),
+                'is_terminal': self.is_terminal,
+                'errors_accumulated': self.errors_accumulated}
+
+    def cache_key(self) -> tuple:
+        """The key by which the results of this guide node are stored in, and retrieved from, the guide node cache."""
+
+        # duplex order is [guide_name, mRNA_dock_index, mRNA_sequence, guide_index]
+        return self.guide_name, self.duplex[1], self.duplex[2].seq, self.duplex[3]
+
     def cache_outputs(self) -> None:
         """Takes the key components of the guide node and places them into a results cache in the 'guide_tree'.
         The key components of the 'init_duplex' (containing initiating mRNA sequence, guide RNA, and associated
-        indices), and output sequences (and indices) are stored in a pandas DataFrame.
+        indices) form the key, under which the output sequences (and indices) are stored in a dict.
 
         In the event that a previous guide_node has been created with the same initial mRNA sequence and guide RNA,
         then the output sequences and indices can be used from this prior determination, saving processing time."""
 
         var_dict = {
             'directory': str(self.edit_tree_path.parent),
-            'guide_name': self.guide_name,
-            'init_dock_index': self.duplex[1],
-            'init_sequence': self.duplex[2].seq,
-            'init_gIndex': self.duplex[3],
             'outputs': self.progressed_sequences
         }
 
-        try:
-            self.guide_tree.guide_node_cache = self.guide_tree.guide_node_cache.append(var_dict, ignore_index=True)
-        except AttributeError:
-            self.guide_tree.guide_node_cache = pd.DataFrame(var_dict)
+        # the first result stored for a key is kept, matching the first match returned by 'check_cache'
+        self.guide_tree.guide_node_cache.setdefault(self.cache_key(), var_dict)
 
         return None
 
@@ -163,23 +192,11 @@ class GuideNode:
         already. If so, it returns a list containing the results from this prior node. If not, it returns
         an empty list."""
 
-        try:
-            df = self.guide_tree.guide_node_cache
-        except AttributeError:
-            return []
-
-        cond_guide = df['guide_name'] == self.guide_name
-        cond_dock = df['init_dock_index'] == self.duplex[1]
-        cond_seq = df['init_sequence'] == self.duplex[2].seq
-        cond_gindex = df['init_gIndex'] == self.duplex[3]
+        cached = self.guide_tree.guide_node_cache.get(self.cache_key())
 
-        condition_mask = cond_guide & cond_dock & cond_seq & cond_gindex
-
-        matches = df[condition_mask]
-
-        if len(matches):
+        if cached:
             self.guide_tree.cache_uses += 1
-            return matches['outputs'].iloc[0]
+            return cached['outputs']
         else:
             return []
 
@@ -226,13 +243,19 @@ class GuideNode:
         if not short_sequence_editing:
             return
 
+        # the leader, trailer, and leader length are the same for every progressed sequence
+        leader = self.leading_string
+        trailer = self.trailing_string
+        leader_length = len(leader)
+
         complete_progressed = []
         for si, (sequence, mIndex) in enumerate(self.progressed_sequences):
-            complete_seq_string = f'{self.leading_string}{sequence.seq}{self.trailing_string}'
+            # joined in a single allocation, rather than copying the (possibly long) leader into an intermediate
+            complete_seq_string = ''.join((leader, sequence.seq, trailer))
             complete_sequence = Sequence(name=sequence.name,
                                          sequence=complete_seq_string,
                                          seq_is_5to3=False)
-            true_mIndex = mIndex + len(self.leading_string)
+            true_mIndex = mIndex + leader_length
             complete_progressed.append((complete_sequence, true_mIndex))
 
         self.progressed_sequences = complete_progressed
@@ -243,13 +266,15 @@ class GuideNode:
         """Counts the accumulated errors, from the 3-prime end of the mRNA up to the current mIndex, base-by-base,
         compared to the known edited mRNA sequence. Only used for QC of the model's development process."""
 
-        known_edited = self.guide_tree.known_edited_sequence.seq
+        # the known edited sequence is shared by the whole guide tree, so its array is only built once
+        known_edited = self.guide_tree.known_edited_sequence.seq_array
         total_errors = []
         for i, (sequence, index) in enumerate(self.progressed_sequences):
-            current_errors = 0
-            for known, model in zip(known_edited[:index], sequence.seq[:index]):
-                if known != model:
-                    current_errors += 1
+            known_bases = known_edited[:index]
+            model_bases = sequence.seq_array[:index]
+            # only the overlapping bases are compared, as when zipping the two sequence strings
+            overlap = min(known_bases.size, model_bases.size)
+            current_errors = int(np.count_nonzero(known_bases[:overlap] != model_bases[:overlap]))
             total_errors.append(current_errors)
 
         return total_errors
@@ -6,8 +6,9 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 import pandas as pd
 import time
 import pickle
+import gzip
+import itertools
 from guide_node import GuideNode
-from pathlib import Path
 import graph_gen
 import outputs_gen
 import log_gen
@@ -25,46 +26,61 @@ class GuideTree:
         self.known_edited_sequence = edited_seq
 
         self.log_path = log_path
-        self.timestamp = time.perf_counter()
-        self.log(message=[f'\nNew guide tree: {self.id}\n'])
-
-        self.guide_node_cache: pd.DataFrame
-        self.cache_uses = 0
-
-        self.root = GuideNode(guide_tree=self, init_duplex=initial_duplex)
-
-        self.guide_nodes_all = [self.root]
-        self.guide_nodes_series = pd.Series(data=self.root.init_sequence.seq)
-        self.existing_children_uses = 0
-        self.guide_nodes_current = [self.root]
-
-        self.guide_levels = 1
-
-        self.is_complete = False
-
-        self.log(prev_nodes=0)
-
-        while (not self.is_complete) and (self.guide_levels < 50):
-            nodes_to_process = len(self.guide_nodes_current)
-            self.grow_tree()
-            self.guide_levels += 1
-            self.log(prev_nodes=nodes_to_process)
-            if not self.guide_nodes_current:
-                self.is_complete = True
-
-        print(f'***********************************************************\n'
-              f'{self.cache_uses} cache uses.\n'
-              f'{self.existing_children_uses} existing children uses.')
-        self.output_data: list
-        # self.graph =
-        graph_gen.graph_guide_tree(self)
-        self.guide_nodes_series.to_csv(self.output_data[1].parent / 'sequence_series')
+        # the log file is held open for the whole build of the tree, rather than reopened for every event
+        self.log_file = open(self.log_path, mode='a', encoding='utf-8')
+        # the log file is closed however the build ends, so that no logged events are lost if it fails
+        try:
+            self.timestamp = time.perf_counter()
+            self.log(message=[f'\nNew guide tree: {self.id}\n'])
+
+            # results of previously computed guide nodes, keyed by their initiating duplex. See GuideNode.cache_outputs
+            self.guide_node_cache = {}
+            self.cache_uses = 0
+            # numbers each guide node within the tree, to give it a unique id
+            self.guide_node_ids = itertools.count(1)
+            # output directories already created for this tree. See outputs_gen.make_parent_dir
+            self.created_dirs = set()
+
+            self.root = GuideNode(guide_tree=self, init_duplex=initial_duplex)
+
+            self.guide_nodes_all = [self.root]
+            # every guide node, grouped by its initiating mRNA sequence, in order of creation. See get_existing_children
+            self.guide_nodes_by_sequence = {self.root.init_sequence.seq: [self.root]}
+            self.existing_children_uses = 0
+            self.guide_nodes_current = [self.root]
+
+            self.guide_levels = 1
+
+            self.is_complete = False
+
+            self.log(prev_nodes=0)
+
+            while (not self.is_complete) and (self.guide_levels < 50):
+                nodes_to_process = len(self.guide_nodes_current)
+                self.grow_tree()
+                self.guide_levels += 1
+                self.log(prev_nodes=nodes_to_process)
+                if not self.guide_nodes_current:
+                    self.is_complete = True
+
+            print(f'***********************************************************\n'
+                  f'{self.cache_uses} cache uses.\n'
+                  f'{self.existing_children_uses} existing children uses.')
+            # the guide node values are written once the tree is complete, rather than rewritten after every level
+            self.output_data = outputs_gen.save_guide_tree(self)
+            # self.graph =
+            graph_gen.graph_guide_tree(self)
+            graph_gen.wait_for_renders()
+            sequence_series = pd.Series(data=[guide_node.init_sequence.seq for guide_node in self.guide_nodes_all])
+            sequence_series.to_csv(self.output_data[1].parent / 'sequence_series')
+        finally:
+            self.log_file.close()
 
     def log(self, prev_nodes=0, message=None) -> None:
         """Appends the latest guide tree-building event to the log file."""
 
         if message:
-            log_gen.append_log(log_path=self.log_path, new_events=message)
+            log_gen.append_log(log_path=self.log_file, new_events=message)
         else:
             last_timestamp = self.timestamp
             self.timestamp = time.perf_counter()
@@ -74,7 +90,7 @@ class GuideTree:
             elapsed = f'Elapsed time: {hrs} hours, {mins} minutes, {secs:0.2f} seconds\n'
             gen_msg = f'Level {self.guide_levels} guide nodes generated. Nodes created: {len(self.guide_nodes_current)}\n'
 
-            log_gen.append_log(log_path=self.log_path, new_events=[lvl_complete_msg, elapsed, gen_msg])
+            log_gen.append_log(log_path=self.log_file, new_events=[lvl_complete_msg, elapsed, gen_msg])
 
         return None
 
@@ -82,13 +98,9 @@ class GuideTree:
         """Checks the init sequences of all existing guide nodes to see if the output sequence has already
         been generated previously."""
 
-        series = self.guide_nodes_series
-        matches = series[series == sequence]
-        matching_indices = matches.index.to_list()
-
-        children = [self.guide_nodes_all[i] for i in matching_indices]
+        children = self.guide_nodes_by_sequence.get(sequence, [])
 
-        # if matching_indices:
+        # if children:
         #     print('matches found ***************************************')
         # else:
         #     print('no matches ********************')
@@ -129,18 +141,18 @@ class GuideTree:
         # self.save_guide_nodes()
         # self.guide_nodes_all += next_nodes
         self.guide_nodes_current = next_nodes
-        self.output_data = outputs_gen.save_guide_tree(self)
 
         return None
 
     def save_guide_nodes(self):
         """Pickles guide nodes from previous levels, and saves them to a file. Freeing up memory and enabling
-        loading at a later stage."""
+        loading at a later stage. Only each node's own results are pickled (see GuideNode.saved_state), compressed
+        with gzip."""
 
         for guide_node in self.guide_nodes_all:
             if isinstance(guide_node, GuideNode):
-                file_path = self.log_path.parent / Path(guide_node.id) / Path('guide_node')
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(file_path, mode='wb') as f:
-                    pickle.dump(guide_node, f)
+                file_path = self.log_path.parent / guide_node.id / 'guide_node'
+                outputs_gen.make_parent_dir(self, file_path)
+                with gzip.open(file_path, mode='wb') as f:
+                    pickle.dump(guide_node.saved_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
                 guide_node = file_path
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 
 from pathlib import Path
+from typing import TextIO, Union
 from datetime import date
 import time
 from run_settings import *
@@ -46,11 +47,16 @@ def gen_setup_file(gene: str, paths: list[Path]) -> Path:
     return log_path
 
 
-def append_log(log_path: Path, new_events: list[str]) -> None:
-    """Appends a given list of events to the initial log file."""
+def append_log(log_path: Union[Path, TextIO], new_events: list[str]) -> None:
+    """Appends a given list of events to the initial log file. Takes either the path to the log, which is opened for
+    this one write, or a log file already open for appending, which is flushed after the write."""
 
-    with open(log_path, mode='a', encoding='utf-8') as f:
-        f.writelines(new_events)
+    if hasattr(log_path, 'write'):
+        log_path.writelines(new_events)
+        log_path.flush()
+    else:
+        with open(log_path, mode='a', encoding='utf-8') as f:
+            f.writelines(new_events)
 
     return None
 
@@ -1,49 +1,81 @@
 """Produces graphs, tables, and saves node raw data to disk."""
 
 import pandas as pd
+import numpy as np
 from type_definitions import NodeType, OutputNodes
 from pathlib import Path
-import copy
+import itertools
+import csv
+from operator import attrgetter
 
 
-def gen_dataframe(edit_tree, which_nodes: OutputNodes) -> pd.DataFrame:
-    """Produces a DataFrame for the edit tree of a given guide node. This can then be saved to disk to minimise
-    memory usage."""
+# the edit node attributes written to the edit node csv files, in order. References to other objects (the tree,
+# parents, children, and Sequence objects) are left out, as only their memory addresses would be written. The
+# sequence string and the ids of related nodes are added as their own columns
+edit_node_columns = ('action', 'progressed', 'to_merge', 'probability_calculated', 'id', 'parent_id', 'edit_level',
+                     'mIndex', 'gIndex', 'prev_gIndex_mismatch_total', 'mismatches', 'node_type', 'cofold_string',
+                     'alignment', 'mfe', 'probability', 'probability_product')
 
-    if which_nodes is OutputNodes.ALL:
-        selected_nodes = [node for node in edit_tree.edit_nodes_all]
-    elif which_nodes is OutputNodes.COMPLETE:
-        selected_nodes = [node for node in edit_tree.edit_nodes_all if node.node_type is NodeType.COMPLETE]
-    else:
-        selected_nodes = [node for node in edit_tree.edit_nodes_all if node.progressed]
+# position of the cofold string in the edit node csv rows. See save_edit_tree
+cofold_string_column = edit_node_columns.index('cofold_string')
+
+# buffer size of the files the edit node csv rows are streamed to
+csv_buffer_size = 1 << 20
+
+
+def make_parent_dir(guide_tree, dest_addr: Path) -> None:
+    """Creates the directory that 'dest_addr' will be saved in. Directories already created for the guide tree are
+    recorded, so that each is only checked on disk once."""
 
-    output_values = [vars(node) for node in selected_nodes] # a list of dicts
+    parent = dest_addr.parent
+    if parent not in guide_tree.created_dirs:
+        parent.mkdir(parents=True, exist_ok=True)
+        guide_tree.created_dirs.add(parent)
 
-    all_child_ids = []
-    for node in selected_nodes:
-        children_ids = [child.id for child in node.children]
-        all_child_ids.append(children_ids)
+    return None
 
-    output_df = pd.DataFrame(output_values)
-    output_df['children_id'] = all_child_ids
-    output_df['sequence.seq'] = [node.sequence.seq for node in selected_nodes]
 
-    return output_df
+def select_edit_nodes(edit_tree, which_nodes: OutputNodes):
+    """Yields the edit nodes of the edit tree to be output: all nodes, or only the complete, or progressed nodes."""
+
+    if which_nodes is OutputNodes.ALL:
+        yield from edit_tree.edit_nodes_all
+    elif which_nodes is OutputNodes.COMPLETE:
+        for node in edit_tree.edit_nodes_all:
+            if node.node_type is NodeType.COMPLETE:
+                yield node
+    else:
+        for node in edit_tree.edit_nodes_all:
+            if node.progressed:
+                yield node
 
 
 def save_edit_tree(guide_node, which_nodes: OutputNodes) -> Path:
     """Saves edit nodes and guide nodes to separate csv files. Can specify the output to include all edit nodes or
     only the complete, or progressed nodes."""
 
-    df_of_edit_nodes = gen_dataframe(edit_tree=guide_node.edit_tree, which_nodes=which_nodes)
-
     tree = guide_node.guide_tree
     level = f'Level_{guide_node.guide_level:03d}'
 
     dest_addr = guide_node.output_path / 'edit_node_values'
-    dest_addr.parent.mkdir(parents=True, exist_ok=True)
-
-    df_of_edit_nodes.to_csv(dest_addr)
+    make_parent_dir(tree, dest_addr)
+
+    # rows are written as each node is read, rather than first gathering the whole edit tree into a DataFrame. The
+    # layout matches DataFrame.to_csv, with a leading index column, and attributes a node doesn't have left empty
+    get_sequence_string = attrgetter('sequence.seq')
+    with open(dest_addr, mode='w', encoding='utf-8', newline='', buffering=csv_buffer_size) as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(('',) + edit_node_columns + ('children_id', 'sequence.seq', 'action_log'))
+        for index, node in enumerate(select_edit_nodes(edit_tree=guide_node.edit_tree, which_nodes=which_nodes)):
+            # vars returns the node's own __dict__ rather than a copy, and its values are looked up by map in a single
+            # C-level pass
+            node_values = list(map(vars(node).get, edit_node_columns))
+            # the cofold string is only cached on nodes that have been co-folded. For the rest it is built here, so
+            # that every row has one, but isn't kept on the node
+            if node_values[cofold_string_column] is None:
+                node_values[cofold_string_column] = node.set_cofold_string()
+            writer.writerow((index, *node_values,
+                             [child.id for child in node.children], get_sequence_string(node), node.action_log))
 
     return dest_addr
 
@@ -51,33 +83,44 @@ def save_edit_tree(guide_node, which_nodes: OutputNodes) -> Path:
 def save_guide_tree(guide_tree) -> tuple:
     """Saves all guide node details to a DataFrame and outputs it as csv."""
 
-    dest_addr = guide_tree.log_path.parent / Path(guide_tree.id) / Path('guide_node_values')
-    dest_addr.parent.mkdir(parents=True, exist_ok=True)
-
-    all_values = []
-    for node in guide_tree.guide_nodes_all:
-        vars_dict = copy.copy(vars(node))
-        vars_dict['progressed_sequences'] = [tup[0].seq for tup in node.progressed_sequences]
-        vars_dict['progressed_indices'] = [tup[1] for tup in node.progressed_sequences]
-        vars_dict['guide'] = node.guide_name.split('_')[1]
-        vars_dict['children_id'] = [child.id for child in node.children]
-        if node.prior:
-            vars_dict['used_priors'] = True
-        else:
-            vars_dict['used_priors'] = False
-        if node.parent:
-            vars_dict['parent_id'] = node.parent.id
-        else:
-            vars_dict['parent_id'] = None
-
-        if vars_dict['progressed_indices']:
-            vars_dict['end_mIndex'] = min(vars_dict['progressed_indices'])
-        else:
-            vars_dict['end_mIndex'] = 1
-
-        all_values.append(vars_dict)
-
-    guides_df = pd.DataFrame(all_values)
+    dest_addr = guide_tree.log_path.parent / guide_tree.id / 'guide_node_values'
+    make_parent_dir(guide_tree, dest_addr)
+
+    # the DataFrame is built column by column. Nodes don't all have the same attributes (e.g. 'node_number' is only
+    # set once a node is processed), so a column first seen part way through is back-filled as missing, and a node
+    # without one of the columns is given a missing value, as pandas does for a list of dicts
+    guide_columns = {}
+    get_sequence_string = attrgetter('seq')
+    for node_count, node in enumerate(guide_tree.guide_nodes_all):
+        progressed_strings = [get_sequence_string(sequence) for sequence, _ in node.progressed_sequences]
+        progressed_indices = [mIndex for _, mIndex in node.progressed_sequences]
+
+        # values replacing or added to the node's own attributes
+        added_values = {
+            'progressed_sequences': progressed_strings,
+            'progressed_indices': progressed_indices,
+            'guide': node.g_name_short,
+            'children_id': [child.id for child in node.children],
+            'used_priors': bool(node.prior),
+            'parent_id': node.parent.id if node.parent else None,
+            'end_mIndex': min(progressed_indices) if progressed_indices else 1
+        }
+
+        for key, value in itertools.chain(vars(node).items(), added_values.items()):
+            column = guide_columns.get(key)
+            if column is None:
+                column = guide_columns[key] = [np.nan] * node_count
+            # an attribute replaced by an added value keeps its original column position
+            if len(column) > node_count:
+                column[node_count] = value
+            else:
+                column.append(value)
+
+        for column in guide_columns.values():
+            if len(column) == node_count:
+                column.append(np.nan)
+
+    guides_df = pd.DataFrame(guide_columns)
 
     guides_df.to_csv(dest_addr)
 
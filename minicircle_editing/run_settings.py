@@ -23,8 +23,12 @@ docking_mode = DockingMode.CURRENT_SITE  # gRNAs preferentially dock to 3' end,
 previous_gRNA_exclusion = gRNAExclusion.ALL # how gRNAs previously used to edit the sequence should be considered in docking
 bulk_cofold = True # If True, edit trees are built with mismatches as the only threshold, with cofolding performed
                     # on all complete, non-leaf nodes once the tree is fully built
+graph_edit_trees = True # if False, no edit tree graphs are produced
 maximum_edit_graph_nodes = 1000
+# number of distinct cofold strings above which RNAcofold is run across a process pool
+parallel_cofold_threshold = 10_000
 short_sequence_editing = True
+qc_mode = False # if True, each guide node's progressed sequences are compared to the known edited sequence
 proportion_to_dock = 0.5
 minimum_mfe = -4
 minimum_adjusted_mfe = -7
@@ -4,29 +4,79 @@ act of importing all sequences (both mRNA and gRNA) to be used in the model.
 It also defines a simple Sequence class for containing the important features of these sequences."""
 
 
+import sys
 from pathlib import Path
 from os import listdir
+from functools import cached_property
+import numpy as np
 from type_definitions import SequenceType
 
 
+# lookup table from ASCII code to the numeric base values used for matrix calculation of binding in docking.
+# Watson-Crick pairs differ by exactly 1 (G-C: 1-2, A-U: 11-12), GU wobble pairs differ by 11. Any other character
+# maps to 'unknown_base', which is too far from every base value to ever be scored as a pair
+unknown_base = -100
+conversion_table = np.full(128, unknown_base, dtype=np.int8)
+conversion_table[[ord(char) for char in 'GgCcAaUu']] = [1, 1, 2, 2, 11, 11, 12, 12]
+
+
 class Sequence:
     """Simple sequence class for containing information about each mRNA or gRNA."""
 
     def __init__(self, name: str, sequence: str, seq_is_5to3=True, seq_type=SequenceType.MESSENGER):
         self.seq_type = seq_type
         self.name = name
+        # only the direction the sequence is given in is stored. The reversed copy (see seq5to3 and seq3to5) is made
+        # only if it is used, as most sequences are only read in their standard direction
         if seq_is_5to3:
             self.seq5to3 = sequence.lower()
         else:
-            self.seq5to3 = sequence[::-1].lower()
-        self.seq3to5 = self.seq5to3[::-1]
+            self.seq3to5 = sequence.lower()
         self.length = len(sequence)
         self.seq: str # Standard sequence for comparisons. Set to 3' to 5' if mRNA, or 5' to 3' for gRNA
+        # the standard sequence is interned, as it is used to key the guide tree's caches. Equal sequences are then
+        # the same object, so lookups compare identity rather than every base
         if self.seq_type is SequenceType.MESSENGER:
+            self.seq3to5 = sys.intern(self.seq3to5)
             self.seq = self.seq3to5
         else:
+            self.seq5to3 = sys.intern(self.seq5to3)
             self.seq = self.seq5to3
 
+    @cached_property
+    def seq5to3(self) -> str:
+        """The sequence 5' to 3', reversed from seq3to5 when first needed."""
+
+        return self.seq3to5[::-1]
+
+    @cached_property
+    def seq3to5(self) -> str:
+        """The sequence 3' to 5', reversed from seq5to3 when first needed."""
+
+        return self.seq5to3[::-1]
+
+    @cached_property
+    def seq_array(self) -> np.ndarray:
+        """The standard sequence (self.seq) as a read-only uint8 array of its ASCII codes, for vectorised
+        comparisons. Only built when first needed, as most sequences produced during editing are never compared this
+        way, then kept for reuse."""
+
+        return np.frombuffer(self.seq.encode('ascii'), dtype=np.uint8)
+
+    @cached_property
+    def converted(self) -> np.ndarray:
+        """The standard sequence converted to the numeric base values of 'conversion_table', for matrix calculation
+        of binding. Only built when first docked, then kept, since the same guides are docked against every mRNA
+        sequence in a run."""
+
+        converted = conversion_table[self.seq_array]
+
+        if np.any(converted == unknown_base):
+            bad_char = self.seq[np.flatnonzero(converted == unknown_base)[0]]
+            raise KeyError(f'Unrecognised base {bad_char!r} in sequence.')
+
+        return converted
+
     # def __eq__(self, other):
     #     return self.seq5to3 == other.seq5to3
 
@@ -35,10 +85,11 @@ def import_mrna(filepath: Path) -> Sequence:
     """Imports the mRNA name and sequence from a fasta file. This is then assigned to a Sequence object.
     Returns a single mRNA Sequence object."""
 
+    # only the name is lower-cased here, as the Sequence object lower-cases the sequence itself
     with open(filepath) as file:
         contents = file.read()
-        whole_file = contents.strip().lower().split('\n')
-        mrna_name = whole_file[0]
+        whole_file = contents.strip().split('\n')
+        mrna_name = whole_file[0].lower()
         mrna_sequence = whole_file[1]
 
         # Place reference mRNA into a Sequence object
@@ -53,10 +104,12 @@ def import_grnas(filepath: Path) -> dict:
 
     with open(filepath) as file:
         contents = file.read()
-        all_grnas = contents.strip().lower().split('\n')
+        all_grnas = contents.strip().split('\n')
 
-    # Split out the name data and sequence data of gRNAs into separate lists
-    grna_names = all_grnas[0::2]
+    # Split out the name data and sequence data of gRNAs into separate lists. The names are interned, as they are
+    # used throughout as dict keys and compared against previously used guides. Only the names are lower-cased here,
+    # as each Sequence object lower-cases its own sequence
+    grna_names = [sys.intern(name.lower()) for name in all_grnas[0::2]]
     grna_sequences = all_grnas[1::2]
 
     # Make a list of all gRNA Sequence objects
@@ -108,14 +161,17 @@ def get_files(mrna_folder: Path, grna_folder: Path, genes: list, edited_mrna_fol
     gene_file_name = user_selection(mrna_file_names)
     output_filepath_mrna = mrna_folder / gene_file_name
 
+    # the selected file and gene names are lower-cased once, rather than for every comparison
+    gene_file_name_lower = gene_file_name.lower()
     selected_gene = ''
     for gene in genes:
-        if gene.lower() in gene_file_name.lower():
+        if gene.lower() in gene_file_name_lower:
             selected_gene = gene
+    selected_gene_lower = selected_gene.lower()
 
     potential_grna_files = []
     for file in grna_file_names:
-        if selected_gene.lower() in file.lower():
+        if selected_gene_lower in file.lower():
             potential_grna_files.append(file)
 
     if len(potential_grna_files) > 1:
@@ -126,7 +182,7 @@ def get_files(mrna_folder: Path, grna_folder: Path, genes: list, edited_mrna_fol
 
     potential_edited_mrna_files = []
     for file in edited_mrna_file_names:
-        if selected_gene.lower() in file.lower():
+        if selected_gene_lower in file.lower():
             potential_edited_mrna_files.append(file)
 
     if len(potential_edited_mrna_files) > 1:
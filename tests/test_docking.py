@@ -0,0 +1,49 @@
+"""Tests for the trimming of the cofold strings sent to RNAcofold."""
+
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'minicircle_editing'))
+
+import RNA
+import docking
+from type_definitions import CofoldMode
+
+
+class TestGenCofoldString(unittest.TestCase):
+
+    messenger = 'gcaugcaugcaugcaugcau'
+    guide = 'auaauuaacg'
+
+    def setUp(self):
+        self.cofold_mode = docking.cofold_mode
+        docking.cofold_mode = CofoldMode.WINDOW_CENTRED
+        docking.gen_cofold_string.cache_clear()
+
+    def tearDown(self):
+        docking.cofold_mode = self.cofold_mode
+        docking.gen_cofold_string.cache_clear()
+
+    def test_window_centred_trim(self):
+        half_window = docking.editing_window // 2
+        docking_idx, gIndex = 4, 5
+        midx_lower = docking_idx + gIndex + 1 - half_window
+        midx_upper = docking_idx + gIndex + half_window
+
+        cofold_string = docking.gen_cofold_string(self.messenger, self.guide, docking_idx, gIndex)
+
+        self.assertEqual(cofold_string.split('&')[0], self.messenger[midx_lower:midx_upper][::-1])
+
+    def test_docked_at_last_mrna_base(self):
+        # no mRNA bases fall within the window, so only the guide is sent to RNAcofold
+        docking_idx, gIndex = len(self.messenger) - 2, 2
+
+        cofold_string = docking.gen_cofold_string(self.messenger, self.guide, docking_idx, gIndex)
+
+        self.assertTrue(cofold_string.startswith('&'))
+        self.assertEqual(RNA.cofold(cofold_string)[1], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()